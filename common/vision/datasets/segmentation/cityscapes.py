@@ -66,7 +66,8 @@ class Cityscapes(SegmentationList):
 
     def parse_label_file(self, label_list_file):
         with open(label_list_file, "r") as f:
-            label_list = [line.strip().replace("leftImg8bit", "gtFine_labelIds") for line in f.readlines()]
+            label_list = [line.replace("leftImg8bit", "gtFine_labelIds")
+                          for line in map(str.strip, f.read().splitlines()) if line]
         return label_list
 
 
@@ -111,5 +112,7 @@ class FoggyCityscapes(Cityscapes):
             List of image path
         """
         with open(file_name, "r") as f:
-            data_list = [line.strip().replace("leftImg8bit", "leftImg8bit_foggy_beta_{}".format(self.beta)) for line in f.readlines()]
+            data_folder = "leftImg8bit_foggy_beta_{}".format(self.beta)
+            data_list = [line.replace("leftImg8bit", data_folder)
+                         for line in map(str.strip, f.read().splitlines()) if line]
         return data_list
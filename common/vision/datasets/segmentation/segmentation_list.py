@@ -3,12 +3,25 @@
 @contact: JiangJunguang1123@outlook.com
 """
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Sequence, Optional, Dict, Callable
 from PIL import Image
 import tqdm
 import numpy as np
 from torch.utils import data
 import torch
+from torchvision.io import read_image, ImageReadMode
+
+
+def pil_loader(path: str) -> Image.Image:
+    """Load an image as a RGB PIL Image"""
+    return Image.open(path).convert('RGB')
+
+
+def tensor_loader(path: str) -> torch.Tensor:
+    """Decode an image directly into a RGB uint8 tensor in shape 3 x H x W, without going through PIL"""
+    return read_image(path, ImageReadMode.RGB)
 
 
 class SegmentationList(data.Dataset):
@@ -26,6 +39,8 @@ class SegmentationList(data.Dataset):
         train_id_to_color (seq, optional): the map between the train id and the color.
         transforms (callable, optional): A function/transform that  takes in  (PIL Image, label) pair \
             and returns a transformed version. E.g, :class:`~common.vision.transforms.segmentation.Resize`.
+        loader (callable, optional): A function to load an image given its path. Use :meth:`tensor_loader` to get \
+            uint8 tensors instead of PIL Images. Default: :meth:`pil_loader`.
 
     .. note:: In ``data_list_file``, each line is the relative path of an image.
         If your data_list_file has different formats, please over-ride :meth:`~SegmentationList.parse_data_file`.
@@ -42,7 +57,7 @@ class SegmentationList(data.Dataset):
     def __init__(self, root: str, classes: Sequence[str], data_list_file: str, label_list_file: str,
                  data_folder: str, label_folder: str,
                  id_to_train_id: Optional[Dict] = None, train_id_to_color: Optional[Sequence] = None,
-                 transforms: Optional[Callable] = None):
+                 transforms: Optional[Callable] = None, loader: Callable = pil_loader):
         self.root = root
         self.classes = classes
         self.data_list_file = data_list_file
@@ -55,6 +70,7 @@ class SegmentationList(data.Dataset):
         self.data_list = self.parse_data_file(self.data_list_file)
         self.label_list = self.parse_label_file(self.label_list_file)
         self.transforms = transforms
+        self.loader = loader
 
     def parse_data_file(self, file_name):
         """Parse file to image list
@@ -66,7 +82,7 @@ class SegmentationList(data.Dataset):
             List of image path
         """
         with open(file_name, "r") as f:
-            data_list = [line.strip() for line in f.readlines()]
+            data_list = [line for line in map(str.strip, f.read().splitlines()) if line]
         return data_list
 
     def parse_label_file(self, file_name):
@@ -79,7 +95,7 @@ class SegmentationList(data.Dataset):
             List of label path
         """
         with open(file_name, "r") as f:
-            label_list = [line.strip() for line in f.readlines()]
+            label_list = [line for line in map(str.strip, f.read().splitlines()) if line]
         return label_list
 
     def __len__(self):
@@ -88,7 +104,7 @@ class SegmentationList(data.Dataset):
     def __getitem__(self, index):
         image_name = self.data_list[index]
         label_name = self.label_list[index]
-        image = Image.open(os.path.join(self.root, self.data_folder, image_name)).convert('RGB')
+        image = self.loader(os.path.join(self.root, self.data_folder, image_name))
         label = Image.open(os.path.join(self.root, self.label_folder, label_name))
         image, label = self.transforms(image, label)
 
@@ -126,36 +142,58 @@ class SegmentationList(data.Dataset):
         """Return a list of the absolute path of all the images"""
         return [os.path.join(self.root, self.data_folder, image_name) for image_name in self.data_list]
 
-    @staticmethod
-    def _save_pil_image(image, path):
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        image.save(path)
+    def _save_translation(self, image, label, image_path, label_path, color=False):
+        image.save(image_path)
+        label.save(label_path)
+        if color:
+            colored_label = self.decode_target(np.array(label))
+            file_name, file_ext = os.path.splitext(label_path)
+            colored_label.save("{}_color{}".format(file_name, file_ext))
 
-    def translate(self, transform: Callable, target_root: str, color=False):
+    def translate(self, transform: Callable, target_root: str, color=False, num_workers=0,
+                  draft_size: Optional[Sequence[int]] = None):
         """ Translate an image and save it into a specified directory
 
+        Images are loaded by ``num_workers`` worker processes and saved by background threads,
+        while ``transform`` runs in the main process.
+
         Args:
             transform (callable): a transform function that maps (image, label) pair from one domain to another domain
             target_root (str): the root directory to save images and labels
+            color (bool): whether to save the colored label as well. Default: False
+            num_workers (int): how many subprocesses to use for loading images. Default: 0
+            draft_size (seq[int], optional): If not None, JPEG images are decoded at a reduced scale that is still \
+                no smaller than this size (width, height), which is faster when ``transform`` downsizes images anyway. \
+                Default: None
 
         """
         os.makedirs(target_root, exist_ok=True)
-        for image_name, label_name in zip(tqdm.tqdm(self.data_list), self.label_list):
+        samples = []
+        for image_name, label_name in zip(self.data_list, self.label_list):
             image_path = os.path.join(target_root, self.data_folder, image_name)
             label_path = os.path.join(target_root, self.label_folder, label_name)
             if os.path.exists(image_path) and os.path.exists(label_path):
                 continue
-            image = Image.open(os.path.join(self.root, self.data_folder, image_name)).convert('RGB')
-            label = Image.open(os.path.join(self.root, self.label_folder, label_name))
-
-            translated_image, translated_label = transform(image, label)
-            self._save_pil_image(translated_image, image_path)
-            self._save_pil_image(translated_label, label_path)
-            if color:
-                colored_label = self.decode_target(np.array(translated_label))
-                file_name, file_ext = os.path.splitext(label_name)
-                self._save_pil_image(colored_label, os.path.join(target_root, self.label_folder,
-                                                                 "{}_color{}".format(file_name, file_ext)))
+            samples.append((os.path.join(self.root, self.data_folder, image_name),
+                            os.path.join(self.root, self.label_folder, label_name), image_path, label_path))
+        # create each output directory once instead of once per image
+        for directory in {os.path.dirname(path) for sample in samples for path in sample[2:]}:
+            os.makedirs(directory, exist_ok=True)
+
+        # batch_size=None yields the (image, label, image_path, label_path) tuples one by one
+        loader = data.DataLoader(_ImageLabelList(samples, draft_size), batch_size=None, num_workers=num_workers)
+        max_pending = 2 * max(num_workers, 1)
+        with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+            pending = deque()
+            for image, label, image_path, label_path in tqdm.tqdm(loader, total=len(samples)):
+                translated_image, translated_label = transform(image, label)
+                pending.append(executor.submit(self._save_translation, translated_image, translated_label,
+                                               image_path, label_path, color))
+                # bound the number of translated images waiting to be saved
+                while len(pending) > max_pending:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
 
     @property
     def evaluate_classes(self):
@@ -165,4 +203,27 @@ class SegmentationList(data.Dataset):
     @property
     def ignore_classes(self):
         """The name of classes to be ignored"""
-        return list(set(self.classes) - set(self.evaluate_classes))
\ No newline at end of file
+        return list(set(self.classes) - set(self.evaluate_classes))
+
+
+class _ImageLabelList(data.Dataset):
+    """Load (image, label) pairs from a list of (image path, label path, target image path, target label path).
+    If draft_size is not None, JPEG images are decoded at a reduced scale no smaller than draft_size."""
+
+    def __init__(self, samples, draft_size=None):
+        self.samples = samples
+        self.draft_size = draft_size
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        image_path, label_path, target_image_path, target_label_path = self.samples[index]
+        image = Image.open(image_path)
+        if self.draft_size is not None:
+            # only takes effect for JPEG, where libjpeg scales down the image while decoding
+            image.draft('RGB', tuple(self.draft_size))
+        image = image.convert('RGB')
+        label = Image.open(label_path)
+        label.load()
+        return image, label, target_image_path, target_label_path
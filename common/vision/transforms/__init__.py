@@ -1,10 +1,17 @@
+import inspect
 import math
 import random
 from PIL import Image
 import numpy as np
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.transforms as T
 from torchvision.transforms import Normalize
 
+# antialias is only available since torch 1.11
+_interpolate_antialias = dict(antialias=True) if 'antialias' in inspect.signature(F.interpolate).parameters else {}
+
 
 class ResizeImage(object):
     """Resize the input PIL Image to the given size.
@@ -85,6 +92,78 @@ class Denormalize(Normalize):
         super().__init__((-mean / std).tolist(), (1 / std).tolist())
 
 
+class FastNormalize(nn.Module):
+    """Normalize a tensor image with mean and standard deviation, the same as
+    :class:`torchvision.transforms.Normalize`, i.e.,
+    ``output[channel] = (input[channel] - mean[channel]) / std[channel]``
+
+    The mean and the reciprocal of std are created once as buffers instead of on every call,
+    and the division is replaced with a multiplication.
+
+    .. note::
+        This transform acts out of place, i.e., it does not mutate the input tensor.
+
+    Args:
+        mean (sequence): Sequence of means for each channel.
+        std (sequence): Sequence of standard deviations for each channel.
+
+    """
+
+    def __init__(self, mean, std):
+        super(FastNormalize, self).__init__()
+        std = torch.tensor(std, dtype=torch.float32)
+        if (std == 0).any():
+            raise ValueError('std evaluated to zero after conversion to {}, leading to division by zero.'.format(std.dtype))
+        self.register_buffer('mean', torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1))
+        self.register_buffer('inv_std', torch.reciprocal(std).view(-1, 1, 1))
+
+    def forward(self, image):
+        return (image - self.mean) * self.inv_std
+
+
+class BatchRandomResizedCrop(nn.Module):
+    """Crop a batch of tensor images to random size and aspect ratio, resize them to the given size
+    and randomly flip them horizontally, so that the augmentation can run on GPU after the images
+    are sent to the device. Each image in the batch gets its own crop and flip.
+
+    Crops are sampled as in :class:`torchvision.transforms.RandomResizedCrop` and resized with bicubic
+    interpolation, antialiased when the installed :func:`torch.nn.functional.interpolate` supports it (torch>=1.11),
+    matching the PIL resize of :class:`~common.vision.transforms.segmentation.RandomResizedCrop`.
+
+    Args:
+        size (sequence): expected output size of the images, as a 2-tuple: (width, height).
+        scale (tuple of float): range of size of the origin size cropped. Default: (0.5, 1.0)
+        ratio (tuple of float): range of aspect ratio of the origin aspect ratio cropped. Default: (3/4, 4/3)
+        p (float): probability of an image being flipped. Default: 0.5
+
+    Inputs:
+        - images (tensor): float images in range [0, 1] in shape N x C x H x W
+
+    Outputs:
+        - augmented images in range [0, 1] in shape N x C x size[1] x size[0]
+    """
+
+    def __init__(self, size, scale=(0.5, 1.0), ratio=(3. / 4., 4. / 3.), p=0.5):
+        super(BatchRandomResizedCrop, self).__init__()
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.p = p
+
+    def forward(self, images):
+        augmented_images = []
+        for image in images:
+            top, left, height, width = T.RandomResizedCrop.get_params(image, self.scale, self.ratio)
+            image = image[:, top:top + height, left:left + width].unsqueeze(dim=0)
+            image = F.interpolate(image, size=(self.size[1], self.size[0]), mode='bicubic', align_corners=False,
+                                  **_interpolate_antialias)
+            if random.random() < self.p:
+                image = image.flip(dims=(-1,))
+            augmented_images.append(image)
+        # bicubic interpolation may overshoot
+        return torch.cat(augmented_images, dim=0).clamp_(0, 1)
+
+
 class NormalizeAndTranspose:
     """
     First, normalize a tensor image with mean and standard deviation.
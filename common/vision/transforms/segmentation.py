@@ -3,6 +3,7 @@
 @contact: JiangJunguang1123@outlook.com
 """
 from PIL import Image
+import inspect
 import random
 import math
 from typing import ClassVar, Sequence, List, Tuple
@@ -11,7 +12,11 @@ import torch
 import torchvision.transforms.functional as F
 import torchvision.transforms.transforms as T
 import torch.nn as nn
-from . import MultipleApply as MultipleApplyBase, NormalizeAndTranspose as NormalizeAndTransposeBase
+from . import MultipleApply as MultipleApplyBase, NormalizeAndTranspose as NormalizeAndTransposeBase, \
+    FastNormalize as FastNormalizeBase
+
+# PIL always antialiases, while tensors are antialiased only when asked for (supported since torchvision 0.13)
+_resized_crop_antialias = dict(antialias=True) if 'antialias' in inspect.signature(F.resized_crop).parameters else {}
 
 
 def wrapper(transform: ClassVar):
@@ -33,7 +38,10 @@ def wrapper(transform: ClassVar):
 
 ColorJitter = wrapper(T.ColorJitter)
 Normalize = wrapper(T.Normalize)
+FastNormalize = wrapper(FastNormalizeBase)
 ToTensor = wrapper(T.ToTensor)
+PILToTensor = wrapper(T.PILToTensor)
+ConvertImageDtype = wrapper(T.ConvertImageDtype)
 ToPILImage = wrapper(T.ToPILImage)
 MultipleApply = wrapper(MultipleApplyBase)
 NormalizeAndTranspose = wrapper(NormalizeAndTransposeBase)
@@ -95,6 +103,31 @@ class Resize(nn.Module):
         return image, label
 
 
+class ResizeLabel(nn.Module):
+    """Resize only the segmentation label to the given size, and keep the image as it is.
+    The label should be a PIL Image.
+
+    Args:
+        label_size (sequence): The requested segmentation label size in pixels, as a 2-tuple:
+          (width, height).
+    """
+
+    def __init__(self, label_size):
+        super(ResizeLabel, self).__init__()
+        self.label_size = label_size
+
+    def forward(self, image, label):
+        """
+        Args:
+            image: (PIL Image or Tensor): Image to be kept.
+            label: (PIL Image): Segmentation label to be scaled.
+
+        Returns:
+            image, rescaled segmentation label
+        """
+        return image, label.resize(self.label_size, Image.NEAREST)
+
+
 class RandomCrop(nn.Module):
     """Crop the given image at a random location.
     The image can be a PIL Image
@@ -130,7 +163,8 @@ class RandomCrop(nn.Module):
 
 
 class RandomHorizontalFlip(nn.Module):
-    """Horizontally flip the given PIL Image randomly with a given probability.
+    """Horizontally flip the given image randomly with a given probability.
+    The image can be a PIL Image or a Tensor in shape C x H x W.
 
     Args:
         p (float): probability of the image being flipped. Default value is 0.5
@@ -143,7 +177,7 @@ class RandomHorizontalFlip(nn.Module):
     def forward(self, image, label):
         """
         Args:
-            image: (PIL Image): Image to be flipped.
+            image: (PIL Image or Tensor): Image to be flipped.
             label: (PIL Image): Segmentation label to be flipped.
 
         Returns:
@@ -156,7 +190,7 @@ class RandomHorizontalFlip(nn.Module):
 
 class RandomResizedCrop(T.RandomResizedCrop):
     """Crop the given image to random size and aspect ratio.
-    The image can be a PIL Image.
+    The image can be a PIL Image or a Tensor in shape C x H x W. The label should be a PIL Image.
 
     A crop of random size (default: of 0.5 to 1.0) of the original size and a random
     aspect ratio (default: of 3/4 to 4/3) of the original aspect ratio is made. This crop
@@ -222,15 +256,20 @@ class RandomResizedCrop(T.RandomResizedCrop):
     def forward(self, image, label):
         """
         Args:
-            image: (PIL Image): Image to be cropped and resized.
+            image: (PIL Image or Tensor): Image to be cropped and resized.
             label: (PIL Image): Segmentation label to be cropped and resized.
 
         Returns:
             Randomly cropped and resized image, randomly cropped and resized segmentation label.
         """
         top, left, height, width = self.get_params(image, self.scale, self.ratio)
-        image = image.crop((left, top, left + width, top + height))
-        image = image.resize(self.size, self.interpolation)
+        if isinstance(image, Tensor):
+            # self.size is (width, height) as in PIL, while F.resized_crop expects (height, width)
+            image = F.resized_crop(image, top, left, height, width, [self.size[1], self.size[0]], self.interpolation,
+                                   **_resized_crop_antialias)
+        else:
+            image = image.crop((left, top, left + width, top + height))
+            image = image.resize(self.size, self.interpolation)
         label = label.crop((left, top, left + width, top + height))
         label = label.resize(self.size, Image.NEAREST)
         return image, label
@@ -5,21 +5,25 @@
 import torch
 import torch.nn as nn
 import torchvision.transforms as T
+import torchvision.transforms.functional as F
 
-from common.vision.transforms import Denormalize
+from common.vision.transforms import Denormalize, FastNormalize
 
 
 class Translation(nn.Module):
     """
     Image Translation Transform Module
 
+    The image is sent to ``device`` as a uint8 tensor, and normalization, translation and
+    denormalization all run there. Only the translated uint8 image is copied back.
+
     Args:
         generator (torch.nn.Module): An image generator, e.g. :meth:`~dalib.translation.cyclegan.resnet_9_generator`
         device (torch.device): device to put the generator. Default: 'cpu'
         mean (tuple): the normalized mean for image
         std (tuple): the normalized std for image
     Input:
-        - image (PIL.Image): raw image in shape H x W x C
+        - image (PIL.Image or tensor): raw image in shape H x W x C, or uint8 tensor in shape C x H x W
 
     Output:
         raw image in shape H x W x 3
@@ -29,17 +33,15 @@ class Translation(nn.Module):
         super(Translation, self).__init__()
         self.generator = generator.to(device)
         self.device = device
-        self.pre_process = T.Compose([
-            T.ToTensor(),
-            T.Normalize(mean, std)
-        ])
-        self.post_process = T.Compose([
-            Denormalize(mean, std),
-            T.ToPILImage()
-        ])
+        self.normalize = FastNormalize(mean, std).to(device)
+        self.denormalize = Denormalize(mean, std)
+        self.to_pil_image = T.ToPILImage()
 
+    @torch.no_grad()
     def forward(self, image):
-        image = self.pre_process(image.copy())  # C x H x W
-        image = image.to(self.device)
-        generated_image = self.generator(image.unsqueeze(dim=0)).squeeze(dim=0).cpu()
-        return self.post_process(generated_image)
+        if not isinstance(image, torch.Tensor):
+            image = F.pil_to_tensor(image)  # C x H x W
+        image = self.normalize(image.to(self.device).float().div_(255))
+        generated_image = self.denormalize(self.generator(image.unsqueeze(dim=0)).squeeze(dim=0))
+        generated_image = generated_image.clamp_(0, 1).mul_(255).byte().cpu()
+        return self.to_pil_image(generated_image)
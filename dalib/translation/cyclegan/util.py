@@ -4,7 +4,6 @@
 """
 import torch.nn as nn
 import functools
-import random
 import torch
 from torch.nn import init
 
@@ -75,6 +74,9 @@ class ImagePool:
     This buffer enables us to update discriminators using a history of generated images
     rather than the ones produced by the latest generators.
 
+    The buffer is a single tensor allocated on the device of the first queried images,
+    so all the queried images should have the same shape.
+
     Args:
         pool_size (int): the size of image buffer, if pool_size=0, no buffer will be created
 
@@ -84,7 +86,7 @@ class ImagePool:
         self.pool_size = pool_size
         if self.pool_size > 0:  # create an empty pool
             self.num_imgs = 0
-            self.images = []
+            self.images = None
 
     def query(self, images):
         """Return an image from the pool.
@@ -100,24 +102,37 @@ class ImagePool:
         """
         if self.pool_size == 0:  # if the buffer size is 0, do nothing
             return images
-        return_images = []
-        for image in images:
-            image = torch.unsqueeze(image.data, 0)
-            if self.num_imgs < self.pool_size:   # if the buffer is not full; keep inserting current images to the buffer
-                self.num_imgs = self.num_imgs + 1
-                self.images.append(image)
-                return_images.append(image)
-            else:
-                p = random.uniform(0, 1)
-                if p > 0.5:  # by 50% chance, the buffer will return a previously stored image, and insert the current image into the buffer
-                    random_id = random.randint(0, self.pool_size - 1)  # randint is inclusive
-                    tmp = self.images[random_id].clone()
-                    self.images[random_id] = image
-                    return_images.append(tmp)
-                else:       # by another 50% chance, the buffer will return the current image
-                    return_images.append(image)
-        return_images = torch.cat(return_images, 0)   # collect all the images and return
-        return return_images
+        images = images.detach()
+        if self.images is None:
+            self.images = images.new_empty((self.pool_size,) + images.shape[1:])
+
+        # if the buffer is not full; keep inserting current images to the buffer
+        num_inserted = min(self.pool_size - self.num_imgs, images.size(0))
+        self.images[self.num_imgs:self.num_imgs + num_inserted] = images[:num_inserted]
+        self.num_imgs += num_inserted
+        if num_inserted == images.size(0):
+            return images
+
+        # by 50% chance, the buffer will return a previously stored image, and insert the current image into the buffer
+        # by another 50% chance, the buffer will return the current image
+        current_images = images[num_inserted:]
+        n = current_images.size(0)
+        shape = (n,) + (1,) * (images.dim() - 1)
+        random_ids = torch.randint(0, self.pool_size, (n,), device=images.device)
+        swap = torch.rand(n, device=images.device) > 0.5
+        # if several images pick the same stored image, only the first one swaps with it,
+        # the others return the current image
+        same_id = random_ids.view(-1, 1) == random_ids.view(1, -1)
+        order = torch.arange(n, device=images.device)
+        earlier = order.view(1, -1) < order.view(-1, 1)
+        swap = swap & ~(same_id & earlier & swap.view(1, -1)).any(dim=1)
+        # images sharing an id all write the same value: the swapped-in image if any, else the stored one
+        swapped_in = same_id & swap.view(1, -1)
+        stored_images = self.images[random_ids]
+        self.images[random_ids] = torch.where(swapped_in.any(dim=1).view(shape),
+                                              current_images[swapped_in.float().argmax(dim=1)], stored_images)
+        return_images = torch.where(swap.view(shape), stored_images, current_images)
+        return torch.cat([images[:num_inserted], return_images], 0)   # collect all the images and return
 
 
 def set_requires_grad(net, requires_grad=False):
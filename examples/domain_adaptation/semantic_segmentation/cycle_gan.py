@@ -8,6 +8,9 @@ import warnings
 import sys
 import argparse
 import itertools
+import contextlib
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -15,13 +18,15 @@ import torch.backends.cudnn as cudnn
 from torch.optim import Adam
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
-from torchvision.transforms import ToPILImage, Compose
+from torchvision.transforms import ConvertImageDtype
+from torchvision.io import write_png
 
 sys.path.append('../../..')
 import dalib.translation.cyclegan as cyclegan
 from dalib.translation.cyclegan.util import ImagePool, set_requires_grad
 import common.vision.datasets.segmentation as datasets
-from common.vision.transforms import Denormalize
+from common.vision.datasets.segmentation.segmentation_list import tensor_loader
+from common.vision.transforms import Denormalize, FastNormalize, BatchRandomResizedCrop
 import common.vision.transforms.segmentation as T
 from common.utils.data import ForeverDataIterator
 from common.utils.meter import AverageMeter, ProgressMeter
@@ -48,21 +53,41 @@ def main(args):
     cudnn.benchmark = True
 
     # Data loading code
-    train_transform = T.Compose([
-        T.RandomResizedCrop(size=args.train_size, ratio=args.resize_ratio, scale=(0.5, 1.)),
-        T.RandomHorizontalFlip(),
-        T.ToTensor(),
-        T.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-    ])
+    # images are decoded into uint8 tensors by tensor_loader, so that crop, resize and flip run on tensors
+    if args.gpu_augmentation:
+        # uint8 images are sent to the device as they are and augmented there batch by batch.
+        # labels are not used by CycleGAN, they are only downsized to keep label remapping and collating cheap
+        train_transform = T.Compose([
+            T.ResizeLabel(args.train_size)
+        ])
+        gpu_transform = nn.Sequential(
+            ConvertImageDtype(torch.float),
+            BatchRandomResizedCrop(size=args.train_size, ratio=args.resize_ratio, scale=(0.5, 1.)),
+            FastNormalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        ).to(device)
+    else:
+        train_transform = T.Compose([
+            T.RandomResizedCrop(size=args.train_size, ratio=args.resize_ratio, scale=(0.5, 1.)),
+            T.RandomHorizontalFlip(),
+            T.ConvertImageDtype(torch.float),
+            T.FastNormalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        ])
+        gpu_transform = None
+    # keep workers alive across epochs; both options are only valid with worker processes
+    loader_kwargs = dict(persistent_workers=True, prefetch_factor=args.prefetch_factor) if args.workers > 0 else {}
     source_dataset = datasets.__dict__[args.source]
-    train_source_dataset = source_dataset(root=args.source_root, transforms=train_transform)
+    train_source_dataset = source_dataset(root=args.source_root, transforms=train_transform,
+                                          loader=tensor_loader)
     train_source_loader = DataLoader(train_source_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, pin_memory=True, drop_last=True)
+                                     shuffle=True, num_workers=args.workers, pin_memory=True, drop_last=True,
+                                     **loader_kwargs)
 
     target_dataset = datasets.__dict__[args.target]
-    train_target_dataset = target_dataset(root=args.target_root, transforms=train_transform)
+    train_target_dataset = target_dataset(root=args.target_root, transforms=train_transform,
+                                          loader=tensor_loader)
     train_target_loader = DataLoader(train_target_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, pin_memory=True, drop_last=True)
+                                     shuffle=True, num_workers=args.workers, pin_memory=True, drop_last=True,
+                                     **loader_kwargs)
 
     train_source_iter = ForeverDataIterator(train_source_loader)
     train_target_iter = ForeverDataIterator(train_target_loader)
@@ -72,14 +97,27 @@ def main(args):
     netG_T2S = cyclegan.generator.__dict__[args.netG](ngf=args.ngf, norm=args.norm, use_dropout=False).to(device)
     netD_S = cyclegan.discriminator.__dict__[args.netD](ndf=args.ndf, norm=args.norm).to(device)
     netD_T = cyclegan.discriminator.__dict__[args.netD](ndf=args.ndf, norm=args.norm).to(device)
+    if args.channels_last:
+        for net in [netG_S2T, netG_T2S, netD_S, netD_T]:
+            net.to(memory_format=torch.channels_last)
 
     # create image buffer to store previously generated images
     fake_S_pool = ImagePool(args.pool_size)
     fake_T_pool = ImagePool(args.pool_size)
 
     # define optimizer and lr scheduler
-    optimizer_G = Adam(itertools.chain(netG_S2T.parameters(), netG_T2S.parameters()), lr=args.lr, betas=(args.beta1, 0.999))
-    optimizer_D = Adam(itertools.chain(netD_S.parameters(), netD_T.parameters()), lr=args.lr, betas=(args.beta1, 0.999))
+    # update all the parameters with a single fused kernel (torch>=1.13, CUDA only) or with multi-tensor kernels
+    adam_parameters = inspect.signature(Adam).parameters
+    if device.type == 'cuda' and 'fused' in adam_parameters:
+        adam_kwargs = dict(fused=True)
+    elif 'foreach' in adam_parameters:
+        adam_kwargs = dict(foreach=True)
+    else:
+        adam_kwargs = {}
+    optimizer_G = Adam(itertools.chain(netG_S2T.parameters(), netG_T2S.parameters()), lr=args.lr, betas=(args.beta1, 0.999),
+                       **adam_kwargs)
+    optimizer_D = Adam(itertools.chain(netD_S.parameters(), netD_T.parameters()), lr=args.lr, betas=(args.beta1, 0.999),
+                       **adam_kwargs)
     lr_decay_function = lambda epoch: 1.0 - max(0, epoch - args.epochs) / float(args.epochs_decay)
     lr_scheduler_G = LambdaLR(optimizer_G, lr_lambda=lr_decay_function)
     lr_scheduler_D = LambdaLR(optimizer_D, lr_lambda=lr_decay_function)
@@ -98,12 +136,19 @@ def main(args):
         lr_scheduler_D.load_state_dict(checkpoint['lr_scheduler_D'])
         args.start_epoch = checkpoint['epoch'] + 1
 
+    if args.compile is not None:
+        # compile in place so that the keys of state_dict stay the same as the uncompiled networks.
+        # input shapes are fixed by --train-size and --batch-size, so kernels are specialized for static shapes
+        for net in [netG_S2T, netG_T2S, netD_S, netD_T]:
+            net.compile(mode=args.compile, dynamic=False)
+
     if args.phase == 'test':
         transform = T.Compose([
             T.Resize(image_size=args.test_input_size),
             T.wrapper(cyclegan.transform.Translation)(netG_S2T, device),
         ])
-        train_source_dataset.translate(transform, args.translated_root)
+        train_source_dataset.translate(transform, args.translated_root, num_workers=args.workers,
+                                       draft_size=args.test_input_size)
         return
 
     # define loss function
@@ -112,10 +157,10 @@ def main(args):
     criterion_identity = nn.L1Loss()
 
     # define visualization function
-    tensor_to_image = Compose([
-        Denormalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        ToPILImage()
-    ])
+    # images are encoded and saved in background threads to keep them off the training loop
+    denormalize = Denormalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    visualize_executor = ThreadPoolExecutor(max_workers=2)
+    visualize_futures = []
 
     def visualize(image, name):
         """
@@ -123,7 +168,13 @@ def main(args):
             image (tensor): image in shape 3 x H x W
             name: name of the saving image
         """
-        tensor_to_image(image).save(logger.get_image_path("{}.png".format(name)))
+        # re-raise errors of the finished writes, e.g. a bad path or a full disk
+        for future in [future for future in visualize_futures if future.done()]:
+            visualize_futures.remove(future)
+            future.result()
+        image = denormalize(image).clamp_(0, 1).mul_(255).byte().cpu()
+        visualize_futures.append(
+            visualize_executor.submit(write_png, image, logger.get_image_path("{}.png".format(name))))
 
     # start training
     for epoch in range(args.start_epoch, args.epochs+args.epochs_decay):
@@ -133,7 +184,7 @@ def main(args):
         # train for one epoch
         train(train_source_iter, train_target_iter, netG_S2T, netG_T2S, netD_S, netD_T,
               criterion_gan, criterion_cycle, criterion_identity, optimizer_G, optimizer_D,
-              fake_S_pool, fake_T_pool, epoch, visualize, args)
+              fake_S_pool, fake_T_pool, gpu_transform, epoch, visualize, args)
 
         # update learning rates
         lr_scheduler_G.step()
@@ -160,14 +211,36 @@ def main(args):
             T.Resize(image_size=args.test_input_size),
             T.wrapper(cyclegan.transform.Translation)(netG_S2T, device),
         ])
-        train_source_dataset.translate(transform, args.translated_root)
+        train_source_dataset.translate(transform, args.translated_root, num_workers=args.workers,
+                                       draft_size=args.test_input_size)
 
+    for future in visualize_futures:
+        future.result()
+    visualize_executor.shutdown()
     logger.close()
 
 
+def autocast(enabled: bool):
+    """Run the enclosed region in bfloat16 on the training device. No gradient scaling is needed for bfloat16.
+    If not enabled, precision is unchanged."""
+    if enabled:
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def discriminator_loss(netD, real, fake, criterion_gan, fuse: bool):
+    """GAN loss for a discriminator on real images and generated images.
+    If fuse, real and generated images are concatenated and fed to the discriminator in a single pass."""
+    if fuse:
+        prediction_real, prediction_fake = netD(torch.cat([real, fake], dim=0)).chunk(2, dim=0)
+    else:
+        prediction_real, prediction_fake = netD(real), netD(fake)
+    return 0.5 * (criterion_gan(prediction_real, True) + criterion_gan(prediction_fake, False))
+
+
 def train(train_source_iter, train_target_iter, netG_S2T, netG_T2S, netD_S, netD_T,
           criterion_gan, criterion_cycle, criterion_identity, optimizer_G, optimizer_D,
-          fake_S_pool, fake_T_pool, epoch: int, visualize, args: argparse.Namespace):
+          fake_S_pool, fake_T_pool, gpu_transform, epoch: int, visualize, args: argparse.Namespace):
     batch_time = AverageMeter('Time', ':4.2f')
     data_time = AverageMeter('Data', ':3.1f')
     losses_G_S2T = AverageMeter('G_S2T', ':3.2f')
@@ -185,83 +258,108 @@ def train(train_source_iter, train_target_iter, netG_S2T, netG_T2S, netD_S, netD
          losses_cycle_S, losses_cycle_T, losses_identity_S, losses_identity_T],
         prefix="Epoch: [{}]".format(epoch))
 
+    # different images fed to the same network can share one forward pass
+    # unless batch normalization mixes their statistics
+    fuse = args.norm != 'batch'
+
+    # calling item() on each loss every iteration would synchronize with the device each time
+    loss_meters = [losses_G_S2T, losses_G_T2S, losses_D_S, losses_D_T,
+                   losses_cycle_S, losses_cycle_T, losses_identity_S, losses_identity_T]
+    pending_losses = []
+
     end = time.time()
 
     for i in range(args.iters_per_epoch):
         real_S, _ = next(train_source_iter)
         real_T, _ = next(train_target_iter)
 
-        real_S = real_S.to(device)
-        real_T = real_T.to(device)
+        real_S = real_S.to(device, non_blocking=True)
+        real_T = real_T.to(device, non_blocking=True)
+        if gpu_transform is not None:
+            real_S = gpu_transform(real_S)
+            real_T = gpu_transform(real_T)
+        if args.channels_last:
+            real_S = real_S.contiguous(memory_format=torch.channels_last)
+            real_T = real_T.contiguous(memory_format=torch.channels_last)
 
         # measure data loading time
         data_time.update(time.time() - end)
 
-        # Compute fake images and reconstruction images.
-        fake_T = netG_S2T(real_S)
-        rec_S = netG_T2S(fake_T)
-        fake_S = netG_T2S(real_T)
-        rec_T = netG_S2T(fake_S)
-
-        # Optimizing generators
-        # discriminators require no gradients
-        set_requires_grad(netD_S, False)
-        set_requires_grad(netD_T, False)
-
-        optimizer_G.zero_grad()
-        # GAN loss D_T(G_S2T(S))
-        loss_G_S2T = criterion_gan(netD_T(fake_T), real=True)
-        # GAN loss D_S(G_T2S(B))
-        loss_G_T2S = criterion_gan(netD_S(fake_S), real=True)
-        # Cycle loss || G_T2S(G_S2T(S)) - S||
-        loss_cycle_S = criterion_cycle(rec_S, real_S) * args.trade_off_cycle
-        # Cycle loss || G_S2T(G_T2S(T)) - T||
-        loss_cycle_T = criterion_cycle(rec_T, real_T) * args.trade_off_cycle
-        # Identity loss
-        # G_S2T should be identity if real_T is fed: ||G_S2T(real_T) - real_T||
-        identity_T = netG_S2T(real_T)
-        loss_identity_T = criterion_identity(identity_T, real_T) * args.trade_off_identity
-        # G_T2S should be identity if real_S is fed: ||G_T2S(real_S) - real_S||
-        identity_S = netG_T2S(real_S)
-        loss_identity_S = criterion_identity(identity_S, real_S) * args.trade_off_identity
-        # combined loss and calculate gradients
-        loss_G = loss_G_S2T + loss_G_T2S + loss_cycle_S + loss_cycle_T + loss_identity_S + loss_identity_T
+        with autocast(args.amp):
+            # Compute fake images, reconstruction images and identity images.
+            # G_S2T should be identity if real_T is fed, and G_T2S should be identity if real_S is fed.
+            if fuse:
+                # images fed to the same generator are concatenated into one batch
+                fake_T, identity_T = netG_S2T(torch.cat([real_S, real_T], dim=0)).chunk(2, dim=0)
+                fake_S, identity_S, rec_S = netG_T2S(torch.cat([real_T, real_S, fake_T], dim=0)).chunk(3, dim=0)
+            else:
+                fake_T = netG_S2T(real_S)
+                rec_S = netG_T2S(fake_T)
+                fake_S = netG_T2S(real_T)
+                identity_T = netG_S2T(real_T)
+                identity_S = netG_T2S(real_S)
+            rec_T = netG_S2T(fake_S)
+
+            # Optimizing generators
+            # discriminators require no gradients
+            set_requires_grad(netD_S, False)
+            set_requires_grad(netD_T, False)
+
+            optimizer_G.zero_grad(set_to_none=True)
+            # GAN loss D_T(G_S2T(S))
+            loss_G_S2T = criterion_gan(netD_T(fake_T), real=True)
+            # GAN loss D_S(G_T2S(B))
+            loss_G_T2S = criterion_gan(netD_S(fake_S), real=True)
+            # Cycle loss || G_T2S(G_S2T(S)) - S||
+            loss_cycle_S = criterion_cycle(rec_S, real_S) * args.trade_off_cycle
+            # Cycle loss || G_S2T(G_T2S(T)) - T||
+            loss_cycle_T = criterion_cycle(rec_T, real_T) * args.trade_off_cycle
+            # Identity loss
+            # ||G_S2T(real_T) - real_T||
+            loss_identity_T = criterion_identity(identity_T, real_T) * args.trade_off_identity
+            # ||G_T2S(real_S) - real_S||
+            loss_identity_S = criterion_identity(identity_S, real_S) * args.trade_off_identity
+            # combined loss and calculate gradients
+            loss_G = loss_G_S2T + loss_G_T2S + loss_cycle_S + loss_cycle_T + loss_identity_S + loss_identity_T
         loss_G.backward()
         optimizer_G.step()
 
         # Optimize discriminator
         set_requires_grad(netD_S, True)
         set_requires_grad(netD_T, True)
-        optimizer_D.zero_grad()
-        # Calculate GAN loss for discriminator D_S
-        fake_S_ = fake_S_pool.query(fake_S.detach())
-        loss_D_S = 0.5 * (criterion_gan(netD_S(real_S), True) + criterion_gan(netD_S(fake_S_), False))
+        optimizer_D.zero_grad(set_to_none=True)
+        with autocast(args.amp):
+            # Calculate GAN loss for discriminator D_S
+            fake_S_ = fake_S_pool.query(fake_S.detach())
+            loss_D_S = discriminator_loss(netD_S, real_S, fake_S_, criterion_gan, fuse)
+            # Calculate GAN loss for discriminator D_T
+            fake_T_ = fake_T_pool.query(fake_T.detach())
+            loss_D_T = discriminator_loss(netD_T, real_T, fake_T_, criterion_gan, fuse)
         loss_D_S.backward()
-        # Calculate GAN loss for discriminator D_T
-        fake_T_ = fake_T_pool.query(fake_T.detach())
-        loss_D_T = 0.5 * (criterion_gan(netD_T(real_T), True) + criterion_gan(netD_T(fake_T_), False))
         loss_D_T.backward()
         optimizer_D.step()
 
+        # keep losses on device, they are copied to the loss meters only before displaying
+        pending_losses.append(torch.stack([loss_G_S2T, loss_G_T2S, loss_D_S, loss_D_T, loss_cycle_S,
+                                           loss_cycle_T, loss_identity_S, loss_identity_T]).detach())
+
         # measure elapsed time
-        losses_G_S2T.update(loss_G_S2T.item(), real_S.size(0))
-        losses_G_T2S.update(loss_G_T2S.item(), real_S.size(0))
-        losses_D_S.update(loss_D_S.item(), real_S.size(0))
-        losses_D_T.update(loss_D_T.item(), real_S.size(0))
-        losses_cycle_S.update(loss_cycle_S.item(), real_S.size(0))
-        losses_cycle_T.update(loss_cycle_T.item(), real_S.size(0))
-        losses_identity_S.update(loss_identity_S.item(), real_S.size(0))
-        losses_identity_T.update(loss_identity_T.item(), real_S.size(0))
         batch_time.update(time.time() - end)
         end = time.time()
 
+        if i % args.print_freq == 0 or i == args.iters_per_epoch - 1:
+            for losses in torch.stack(pending_losses).tolist():
+                for meter, loss in zip(loss_meters, losses):
+                    meter.update(loss, real_S.size(0))
+            pending_losses.clear()
+
         if i % args.print_freq == 0:
             progress.display(i)
 
             for tensor, name in zip([real_S, real_T, fake_S, fake_T, rec_S, rec_T, identity_S, identity_T],
                                     ["real_S", "real_T", "fake_S", "fake_T", "rec_S",
                                      "rec_T", "identity_S", "identity_T"]):
-                visualize(tensor[0], "{}_{}".format(i, name))
+                visualize(tensor[0].float(), "{}_{}".format(i, name))
 
 
 if __name__ == '__main__':
@@ -279,6 +377,10 @@ if __name__ == '__main__':
                         help='the resize ratio for the random resize crop')
     parser.add_argument('--train-size', nargs='+', type=int, default=(1024, 512),
                         help='the input and output image size during training')
+    parser.add_argument('--gpu-augmentation', action='store_true',
+                        help='crop, resize and flip the training images on GPU batch by batch. '
+                             'All the images in a domain should have the same size. '
+                             'Works best with a larger batch size.')
     # model parameters
     parser.add_argument('--ngf', type=int, default=64, help='# of gen filters in the last conv layer')
     parser.add_argument('--ndf', type=int, default=64, help='# of discrim filters in the first conv layer')
@@ -292,6 +394,13 @@ if __name__ == '__main__':
                         help="Where restore model parameters from.")
     parser.add_argument('--trade-off-cycle', type=float, default=10.0, help='trade off for cycle loss')
     parser.add_argument('--trade-off-identity', type=float, default=5.0, help='trade off for identity loss')
+    parser.add_argument('--amp', action='store_true',
+                        help='run forward passes and losses in bfloat16 with autocast')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='use channels last (NHWC) memory format for the networks and the images')
+    parser.add_argument('--compile', type=str, default=None, choices=['default', 'reduce-overhead', 'max-autotune'],
+                        help='compile the generators and discriminators with torch.compile in the given mode, '
+                             'specialized for static input shapes. Default: not compiled')
     # training parameters
     parser.add_argument('-b', '--batch-size', default=1, type=int,
                         metavar='N',
@@ -300,6 +409,8 @@ if __name__ == '__main__':
     parser.add_argument('--beta1', type=float, default=0.5, help='momentum term of adam')
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='N',
                         help='number of data loading workers (default: 4)')
+    parser.add_argument('--prefetch-factor', default=4, type=int, metavar='N',
+                        help='number of batches loaded in advance by each worker (default: 4)')
     parser.add_argument('--epochs', default=20, type=int, metavar='N',
                         help='number of total epochs to run')
     parser.add_argument('--epochs-decay', type=int, default=20,